@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+"""
+Helpers for the archive formats that need more than zipfile/rar.py.
+
+.cbt (tar) has no central directory, so finding a page means walking every
+header before it. We walk them once, note where each member's data starts and
+how long it is, and save that as JSON next to the other cached bits. After
+that any page is a seek and a read away, even across restarts.
+
+.cb7 (7z) archives are usually solid, so getting at page 20 means decoding
+pages 1-19 first. Rather than pay that for every page, we extract the whole
+archive in one pass with the 7z command line tool, run as a child process so
+the reactor keeps serving everyone else, and serve the pages from disk the
+same way .cbz files are handled.
+"""
+
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import os
+from shutil import rmtree
+import tarfile
+
+from twisted.internet import defer
+from twisted.internet.utils import getProcessValue
+from twisted.python.failure import Failure
+from twisted.python.procutils import which
+
+logger = logging.getLogger("comix")
+
+# Tried in order. p7zip installs some subset of these depending on platform.
+SEVEN_ZIP_COMMANDS = ["7z", "7za", "7zr"]
+
+# Written into a 7z extraction folder once 7z has exited cleanly
+COMPLETE_MARKER = ".complete"
+
+# Deferreds waiting on a 7z extraction that's already running, keyed by path
+EXTRACTIONS = {}
+
+# In-memory copies of the tar indexes we've already loaded, keyed by path
+TAR_INDEXES = {}
+
+
+class FileSlice(object):
+    """
+    A read-only file-like view of size bytes starting at offset in fp, so a
+    single member of an archive can be handed straight to FileSender.
+    """
+    def __init__(self, fp, offset, size):
+        self.fp = fp
+        self.fp.seek(offset)
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        if not size:
+            return ""
+        data = self.fp.read(size)
+        self.remaining = self.remaining - len(data)
+        return data
+
+    def close(self):
+        self.fp.close()
+
+
+def tar_index(path, index_directory):
+    """
+    Return an OrderedDict of {member name: (data offset, size)} for the
+    regular files in the tar archive at path, in archive order, or None if it
+    isn't an uncompressed tar.
+
+    The index is kept in memory and in index_directory; either copy is thrown
+    away if the archive's size or modification time has changed since.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    signature = [stat.st_size, int(stat.st_mtime)]
+
+    cached = TAR_INDEXES.get(path, None)
+    if cached and cached["signature"] == signature:
+        return cached["members"]
+
+    index_path = os.path.join(index_directory,
+                              hashlib.sha1(path).hexdigest() + ".json")
+    try:
+        f = open(index_path, "r")
+        try:
+            cached = json.load(f)
+        finally:
+            f.close()
+        if cached.get("signature") != signature:
+            cached = None
+    except (IOError, ValueError):
+        cached = None
+
+    if not cached:
+        members = build_tar_index(path)
+        if members is None:
+            return None
+        cached = {"signature": signature, "members": members}
+        try:
+            if not os.path.exists(index_directory):
+                os.makedirs(index_directory)
+            f = open(index_path, "w")
+            try:
+                # Tar names are just bytes, latin-1 gets them through JSON intact
+                json.dump(cached, f, encoding="latin-1")
+            finally:
+                f.close()
+        except (IOError, OSError):
+            logger.warn("Unable to save the index for %s to %s" % (path, index_path))
+
+    cached["members"] = OrderedDict(
+        (_to_bytes(name), (offset, size)) for name, offset, size in cached["members"]
+    )
+    TAR_INDEXES[path] = cached
+    return cached["members"]
+
+
+def _to_bytes(name):
+    if isinstance(name, unicode):
+        return name.encode("latin-1")
+    return name
+
+
+def build_tar_index(path):
+    """
+    Walk every header in the tar at path once, in archive order.
+    Returns a list of (name, data offset, size) or None if it can't be read.
+    Compressed tars are refused: offsets into them are no use for seeking.
+    """
+    try:
+        tar = tarfile.open(path, "r:")
+    except (tarfile.TarError, IOError):
+        logger.warn("Could not read %s as an uncompressed tar" % path)
+        return None
+    try:
+        return [(m.name, m.offset_data, m.size) for m in tar if m.isfile()]
+    finally:
+        tar.close()
+
+
+def extract_7z(path, storage_path):
+    """
+    Extract everything in the 7z archive at path in a single pass, without
+    blocking the reactor. Returns a Deferred that fires with the extracted
+    file paths, or None if no 7z tool could do it.
+
+    Each archive gets its own folder under storage_path, named after the sha1
+    of its full path. A finished extraction is only reused if its completion
+    marker is there and matches the archive's current size and mtime, so a
+    crash part way through or a changed archive means extracting again.
+    Concurrent requests for the same archive share one extraction.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return defer.succeed(None)
+    signature = [stat.st_size, int(stat.st_mtime)]
+    folder_path = os.path.join(storage_path, "7z-" + hashlib.sha1(path).hexdigest())
+    marker_path = os.path.join(folder_path, COMPLETE_MARKER)
+
+    try:
+        f = open(marker_path, "r")
+        try:
+            if json.load(f) == signature:
+                return defer.succeed(_list_files(folder_path))
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        pass
+
+    if path in EXTRACTIONS:
+        d = defer.Deferred()
+        EXTRACTIONS[path].append(d)
+        return d
+
+    command = None
+    for name in SEVEN_ZIP_COMMANDS:
+        found = which(name)
+        if found:
+            command = found[0]
+            break
+    if command is None:
+        logger.warn("Install p7zip to read %s: none of %s were found" % (
+            path, ", ".join(SEVEN_ZIP_COMMANDS)))
+        return defer.succeed(None)
+
+    # Whatever is there is stale or half-done
+    rmtree(folder_path, ignore_errors=True)
+    os.makedirs(folder_path)
+
+    def cbExtracted(result):
+        if result != 0:
+            logger.warn("%s could not extract %s (exit code %d)" % (command, path, result))
+            rmtree(folder_path, ignore_errors=True)
+            return None
+        f = open(marker_path, "w")
+        try:
+            json.dump(signature, f)
+        finally:
+            f.close()
+        return _list_files(folder_path)
+
+    def cbNotify(result):
+        for waiter in EXTRACTIONS.pop(path, []):
+            if isinstance(result, Failure):
+                waiter.errback(result)
+            else:
+                waiter.callback(result)
+        return result
+
+    EXTRACTIONS[path] = []
+    d = getProcessValue(command, ["x", "-y", "-o" + folder_path, path],
+                        env=os.environ)
+    d.addCallback(cbExtracted)
+    d.addBoth(cbNotify)
+    return d
+
+
+def _list_files(folder_path):
+    paths = []
+    for root, dirnames, filenames in os.walk(folder_path):
+        for f in filenames:
+            if f != COMPLETE_MARKER:
+                paths.append(os.path.join(root, f))
+    paths.sort()
+    return paths
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+"""
+Load generator for the comix server.
+
+Builds a synthetic library in a temporary directory (or uses an existing one),
+serves it with server.Site(ComicServer(...)) on a local port and then lets a
+number of simulated readers loose on it. Each reader does what a person would:
+look at the root listing, pick a title, open an issue and page through it,
+pausing for a while on each page.
+
+When the run is over we print p50/p95/p99 latency, request counts and error
+rates per route, plus overall throughput, so two builds can be compared before
+deploying either of them.
+
+Note: the readers share the reactor with the server, so the numbers include
+client overhead. That's fine for comparing builds against each other, less so
+for absolute capacity planning.
+
+Usage: python loadtest.py --readers 20 --duration 60
+"""
+
+import math
+import optparse
+import os
+import random
+import re
+from shutil import rmtree
+import sys
+import tempfile
+import time
+import zipfile
+
+from twisted.internet import reactor, defer, task
+from twisted.web import server, client
+
+from server import ComicServer, logger
+
+LINK_RE = re.compile('href="([^"]+)"')
+
+# Order matters when printing the report
+ROUTES = ["root", "title", "issue", "page", "download", "other"]
+
+
+def classify(path):
+    """
+    Figure out which of the server's routes a path will end up at, so results
+    can be grouped the same way get_matching_response groups them.
+    """
+    parts = filter(None, path.split("?")[0].split("/"))
+    if not parts:
+        return "root"
+    if parts[0] == "issue" and len(parts) == 3:
+        return "issue"
+    if parts[0] == "page" and len(parts) == 4:
+        return "page"
+    if parts[0] == "download" and len(parts) == 3:
+        return "download"
+    if len(parts) == 1:
+        return "title"
+    return "other"
+
+
+def percentile(values, pct):
+    """
+    Nearest-rank percentile of an already-sorted list. Returns None for an
+    empty list so the report can show a dash instead of a made-up number.
+    """
+    if not values:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+def build_library(directory, titles, issues, pages, page_size):
+    """
+    Fill directory with titles x issues .cbz files, each holding a number of
+    fake .jpg pages. The page contents are random bytes - the server never
+    looks inside them, so there's no point making them real images.
+    """
+    total = 0
+    for t in range(titles):
+        folder = os.path.join(directory, "Load Test Title %03d" % (t + 1))
+        os.makedirs(folder)
+        for i in range(issues):
+            path = os.path.join(folder, "Load Test Title %03d - %03d.cbz" % (t + 1, i + 1))
+            z = zipfile.ZipFile(path, "w", zipfile.ZIP_STORED)
+            for p in range(pages):
+                z.writestr("page%03d.jpg" % (p + 1), os.urandom(page_size))
+            z.close()
+            total = total + 1
+    return total
+
+
+class Stats(object):
+    """
+    Latency and error bookkeeping, grouped by route
+    """
+    def __init__(self):
+        self.latencies = dict((route, []) for route in ROUTES)
+        self.errors = dict((route, 0) for route in ROUTES)
+        self.started = None
+        self.stopped = None
+
+    def record(self, route, elapsed, failed=False):
+        if failed:
+            self.errors[route] = self.errors[route] + 1
+        else:
+            self.latencies[route].append(elapsed)
+
+    def report(self, out=sys.stdout):
+        elapsed = (self.stopped or time.time()) - self.started
+        total = 0
+        total_errors = 0
+        out.write("%-6s %8s %8s %7s %9s %9s %9s\n" % (
+            "route", "requests", "errors", "err %", "p50 ms", "p95 ms", "p99 ms"))
+        for route in ROUTES:
+            timings = sorted(self.latencies[route])
+            errors = self.errors[route]
+            count = len(timings) + errors
+            if not count:
+                continue
+            total = total + count
+            total_errors = total_errors + errors
+            out.write("%-6s %8d %8d %6.1f%% %9s %9s %9s\n" % (
+                route, count, errors, 100.0 * errors / count,
+                self._ms(percentile(timings, 50)),
+                self._ms(percentile(timings, 95)),
+                self._ms(percentile(timings, 99))))
+        out.write("\n%d requests, %d errors in %.1fs: %.1f requests/s\n" % (
+            total, total_errors, elapsed, total / elapsed if elapsed else 0))
+
+    def _ms(self, value):
+        if value is None:
+            return "-"
+        return "%.1f" % (value * 1000)
+
+
+class Reader(object):
+    """
+    One simulated person reading comics. Browses from the root listing down to
+    a page, then reads through the issue at think_time (on average) per page.
+    Some readers give up on an issue part way through, like real ones do.
+    """
+    def __init__(self, base_url, stats, think_time, deadline):
+        self.base_url = base_url
+        self.stats = stats
+        self.think_time = think_time
+        self.deadline = deadline
+
+    def done(self):
+        return time.time() >= self.deadline
+
+    @defer.inlineCallbacks
+    def fetch(self, path):
+        route = classify(path)
+        start = time.time()
+        try:
+            body = yield client.getPage(self.base_url + path)
+        except Exception, e:
+            self.stats.record(route, time.time() - start, failed=True)
+            logger.debug("%s failed: %s" % (path, e))
+            defer.returnValue(None)
+        self.stats.record(route, time.time() - start)
+        defer.returnValue(body)
+
+    def think(self):
+        """
+        Wait for an exponentially distributed time, like a human would.
+        Capped at 5x the mean so a single reader doesn't disappear for ages.
+        """
+        if not self.think_time:
+            return defer.succeed(None)
+        delay = min(random.expovariate(1.0 / self.think_time), self.think_time * 5)
+        return task.deferLater(reactor, delay, lambda: None)
+
+    def links(self, body, prefix):
+        if not body:
+            return []
+        return [l for l in LINK_RE.findall(body) if l.startswith(prefix)]
+
+    @defer.inlineCallbacks
+    def run(self):
+        while not self.done():
+            root = yield self.fetch("/")
+            titles = [l for l in self.links(root, "/") if classify(l) == "title"]
+            if not titles:
+                yield self.think()
+                continue
+            yield self.think()
+
+            title = yield self.fetch(random.choice(titles))
+            issues = self.links(title, "/issue/")
+            if not issues or self.done():
+                continue
+            yield self.think()
+
+            issue = yield self.fetch(random.choice(issues))
+            pages = self.links(issue, "/page/")
+            # Most people finish an issue, some wander off early
+            if random.random() < 0.2 and pages:
+                pages = pages[:random.randint(1, len(pages))]
+            for page in pages:
+                if self.done():
+                    break
+                yield self.fetch(page)
+                yield self.think()
+
+
+@defer.inlineCallbacks
+def run(options, directory):
+    site = server.Site(ComicServer(directory))
+    port = reactor.listenTCP(0, site, interface="127.0.0.1")
+    base_url = "http://127.0.0.1:%d" % port.getHost().port
+    logger.info("Load testing %s with %d readers for %ds" % (
+        base_url, options.readers, options.duration))
+
+    stats = Stats()
+    stats.started = time.time()
+    deadline = stats.started + options.duration
+    readers = []
+    for n in range(options.readers):
+        reader = Reader(base_url, stats, options.think_time, deadline)
+        # Stagger arrivals so everybody doesn't hit the root page at once
+        d = task.deferLater(reactor, random.uniform(0, options.ramp_up), reader.run)
+        readers.append(d)
+    yield defer.DeferredList(readers)
+    stats.stopped = time.time()
+    yield port.stopListening()
+    stats.report()
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-r", "--readers", type="int", default=10,
+                      help="concurrent simulated readers [%default]")
+    parser.add_option("-d", "--duration", type="int", default=30,
+                      help="length of the run in seconds [%default]")
+    parser.add_option("-t", "--think-time", type="float", default=2.0,
+                      help="mean seconds a reader spends on each page [%default]")
+    parser.add_option("--ramp-up", type="float", default=5.0,
+                      help="spread reader arrivals over this many seconds [%default]")
+    parser.add_option("--library", default=None,
+                      help="serve this directory instead of a synthetic library")
+    parser.add_option("--titles", type="int", default=20,
+                      help="synthetic library: number of titles [%default]")
+    parser.add_option("--issues", type="int", default=10,
+                      help="synthetic library: issues per title [%default]")
+    parser.add_option("--pages", type="int", default=24,
+                      help="synthetic library: pages per issue [%default]")
+    parser.add_option("--page-size", type="int", default=200 * 1024,
+                      help="synthetic library: bytes per page [%default]")
+    options, args = parser.parse_args(argv)
+
+    directory = options.library
+    synthetic = directory is None
+    if synthetic:
+        directory = tempfile.mkdtemp(prefix="comix-loadtest-")
+        total = build_library(directory, options.titles, options.issues,
+                              options.pages, options.page_size)
+        logger.info("Built a synthetic library of %d issues in %s" % (total, directory))
+
+    def finished(result):
+        if synthetic:
+            rmtree(directory, ignore_errors=True)
+        reactor.stop()
+        return result
+
+    def start():
+        d = defer.maybeDeferred(run, options, directory)
+        d.addErrback(lambda f: logger.critical(f.getTraceback()))
+        d.addBoth(finished)
+
+    reactor.callWhenRunning(start)
+    reactor.run()
+
+# run as script
+if __name__ == '__main__':
+    main()
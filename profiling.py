@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""
+Opt-in request profiling for the comix server.
+
+A RequestProfiler decides which requests to profile - a random fraction of
+them, anything whose path matches a regex, or both - runs those under cProfile
+and folds the results into one aggregate pstats.Stats. Every flush_every
+profiled requests the aggregate is written out to a .pstats file, rotated the
+same way logging.handlers.RotatingFileHandler rotates logs (comix.pstats,
+comix.pstats.1, ...), so a long-running server never fills up the disk.
+
+Read the dumps with the standard library:
+    python -m pstats profiles/comix.pstats
+"""
+
+import cProfile
+import os
+import pstats
+import random
+import re
+import threading
+
+BASE_FILENAME = "comix.pstats"
+
+
+class RequestProfiler(object):
+    def __init__(self, directory, sample_rate=0.0, pattern=None,
+                 flush_every=50, backup_count=10):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.pattern = pattern
+        self.flush_every = flush_every
+        self.backup_count = backup_count
+        self.stats = None
+        self.pending = 0
+        self.total = 0
+        self._lock = threading.Lock()
+
+    def _get_pattern(self):
+        return self._pattern
+
+    def _set_pattern(self, pattern):
+        """
+        Accept either a regex string or None. An empty string turns route
+        matching off, which is what you get from ?pattern= on the debug page.
+        """
+        self._pattern = re.compile(pattern) if pattern else None
+
+    pattern = property(_get_pattern, _set_pattern)
+
+    @property
+    def enabled(self):
+        return self.sample_rate > 0 or self._pattern is not None
+
+    def should_profile(self, path):
+        if self._pattern is not None and self._pattern.search(path):
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def runcall(self, func, *args, **kwargs):
+        """
+        Call func under cProfile and add the result to the aggregate stats.
+
+        Note this only sees the synchronous part of a request - for a static
+        file that's the lookup/extraction, not the FileSender transfer that
+        happens later in the reactor.
+        """
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            self._add(profile)
+
+    def _add(self, profile):
+        with self._lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+            self.pending = self.pending + 1
+            self.total = self.total + 1
+            if self.pending >= self.flush_every:
+                self._dump()
+
+    def dump(self):
+        """
+        Write whatever has been collected so far. Returns the path written,
+        or None if there was nothing to write.
+        """
+        with self._lock:
+            return self._dump()
+
+    def _dump(self):
+        if self.stats is None:
+            return None
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        path = os.path.join(self.directory, BASE_FILENAME)
+        self._rotate(path)
+        self.stats.dump_stats(path)
+        self.stats = None
+        self.pending = 0
+        return path
+
+    def _rotate(self, path):
+        """
+        Shuffle path.1 -> path.2 and so on, dropping anything past backup_count,
+        then move path itself to path.1
+        """
+        if self.backup_count < 1:
+            return
+        for n in range(self.backup_count - 1, 0, -1):
+            source = "%s.%d" % (path, n)
+            if os.path.exists(source):
+                target = "%s.%d" % (path, n + 1)
+                if os.path.exists(target):
+                    os.remove(target)
+                os.rename(source, target)
+        if os.path.exists(path):
+            target = path + ".1"
+            if os.path.exists(target):
+                os.remove(target)
+            os.rename(path, target)
+
+    def status(self):
+        return {
+            "sample rate": self.sample_rate,
+            "pattern": self._pattern.pattern if self._pattern else "",
+            "profiled": self.total,
+            "pending": self.pending,
+            "directory": self.directory,
+        }
@@ -143,10 +143,16 @@ class RarFile(object):
     _filePassed = None #: Whether an already-open file handle was passed in.
 
     # I just put all public members here as a matter of course.
-    filelist = None #: A C{list} of L{RarInfo} objects corresponding to the contents.
+    filelist = None #: A C{list} of L{RarInfo} objects corresponding to the contents. (Only those read so far if C{lazy})
     debug = 0       #: Debugging verbosity. Effective range is currently 0 to 1.
+    _scan_offset = None #: Offset of the next unread block or C{None} once all have been read.
 
-    def __init__(self, handle):
+    def __init__(self, handle, lazy=False):
+        """
+        @param handle: A path or an already-open file-like object.
+        @param lazy: Don't read any block headers up front. They'll be read
+            as needed by L{iterinfo} (or all at once by L{infolist}).
+        """
         # If we've been given a path, get our desired file-like object.
         if isinstance(handle, basestring):
             self_filePassed = False
@@ -168,9 +174,11 @@ class RarFile(object):
             raise BadRarFile("Not a valid RAR file")
 
         self.filelist = []
+        self._scan_offset = start_offset
 
         # Actually read the file metadata.
-        self._getContents()
+        if not lazy:
+            self._getContents()
 
     def __del__(self):
         """Close the file handle if we opened it... just in case the underlying
@@ -183,66 +191,83 @@ class RarFile(object):
         the author so chooses, writing of uncompressed RAR files may be
         implemented in a later version more easily.
         """
-        while True:
-            offset = self.fp.tell()
-
-            # Read the fields present in every type of block header
-            try:
-                head_crc, head_type, head_flags, head_size = self._read_struct(_struct_blockHeader)
-            except struct.error:
-                # If it fails here, we've reached the end of the file.
-                return
+        while self._scan_offset is not None:
+            self._readBlock()
 
-            # Read the optional field ADD_SIZE if present.
-            if head_flags & 0x8000:
-                add_size = self._read_struct(_struct_addSize)[0]
-            else:
-                add_size = 0
-
-            # TODO: Rework handling of archive headers.
-            if head_type == 0x73:
-                #TODO: Try to factor this out to reduce time spent in syscalls.
-                self.fp.seek(offset + 2) # Seek to just after HEAD_CRC
-                #FIXME: Check header CRC on all blocks.
-                assert self._check_crc(self.fp.read(11), head_crc)
-
-            # TODO: Rework handling of file headers.
-            elif head_type == 0x74:
-                unp_size, host_os, file_crc, ftime, unp_ver, method, name_size, attr = self._read_struct(_struct_fileHead_add1)
-
-                # FIXME: What encoding does WinRAR use for filenames?
-                # TODO: Verify that ftime is seconds since the epoch as it seems
-                fileinfo = RarInfo(self.fp.read(name_size), ftime)
-                fileinfo.compress_size = add_size
-                fileinfo.header_offset = offset
-                fileinfo.file_size = unp_size   #TODO: What about >2GiB files? (Zip64 equivalent?)
-                fileinfo.CRC = file_crc         #TODO: Verify the format matches that ZipInfo uses.
-                fileinfo.compress_type = method
-
-                # Note: RAR seems to have copied the encoding methods used by
-                # Zip for these values.
-                fileinfo.create_system = host_os
-                fileinfo.extract_version = unp_ver
-                fileinfo.external_attr = attr  #TODO: Verify that this is correct.
-
-                # Handle flags
-                fileinfo.flag_bits = head_flags
-                fileinfo.not_first_piece = head_flags & 0x01
-                fileinfo.not_last_piece = head_flags & 0x02
-                fileinfo.is_encrypted = head_flags & 0x04
-                #TODO: Handle comments
-                fileinfo.is_solid = head_flags & 0x10
-
-                # TODO: Verify this is correct handling of bits 7,6,5 == 111
-                fileinfo.is_directory = head_flags & 0xe0
-
-                self.filelist.append(fileinfo)
-            elif self.debug > 0:
-                sys.stderr.write("Unhandled block: %s\n" % self._block_types.get(head_type, 'Unknown (0x%x)' % head_type))
-
-            # Line up for the next block
+    def _readBlock(self):
+        """Read the block at L{_scan_offset}, append it to L{filelist} if
+        it's a file header and line up L{_scan_offset} for the next one.
+
+        @returns: The new L{RarInfo} or C{None} for any other kind of block.
+        """
+        offset = self._scan_offset
+        self.fp.seek(offset)
+        fileinfo = None
+
+        # Read the fields present in every type of block header
+        try:
+            head_crc, head_type, head_flags, head_size = self._read_struct(_struct_blockHeader)
+        except struct.error:
+            # If it fails here, we've reached the end of the file.
+            self._scan_offset = None
+            return None
+
+        # A header can't be smaller than its own fixed fields. Rather than
+        # seeking to the same place forever, treat it as the end.
+        if head_size < _struct_blockHeader.size:
+            self._scan_offset = None
+            return None
+
+        # Read the optional field ADD_SIZE if present.
+        if head_flags & 0x8000:
+            add_size = self._read_struct(_struct_addSize)[0]
+        else:
+            add_size = 0
+
+        # TODO: Rework handling of archive headers.
+        if head_type == 0x73:
             #TODO: Try to factor this out to reduce time spent in syscalls.
-            self.fp.seek(offset + head_size + add_size)
+            self.fp.seek(offset + 2) # Seek to just after HEAD_CRC
+            #FIXME: Check header CRC on all blocks.
+            assert self._check_crc(self.fp.read(11), head_crc)
+
+        # TODO: Rework handling of file headers.
+        elif head_type == 0x74:
+            unp_size, host_os, file_crc, ftime, unp_ver, method, name_size, attr = self._read_struct(_struct_fileHead_add1)
+
+            # FIXME: What encoding does WinRAR use for filenames?
+            # TODO: Verify that ftime is seconds since the epoch as it seems
+            fileinfo = RarInfo(self.fp.read(name_size), ftime)
+            fileinfo.compress_size = add_size
+            fileinfo.header_offset = offset
+            fileinfo.file_size = unp_size   #TODO: What about >2GiB files? (Zip64 equivalent?)
+            fileinfo.CRC = file_crc         #TODO: Verify the format matches that ZipInfo uses.
+            fileinfo.compress_type = method
+
+            # Note: RAR seems to have copied the encoding methods used by
+            # Zip for these values.
+            fileinfo.create_system = host_os
+            fileinfo.extract_version = unp_ver
+            fileinfo.external_attr = attr  #TODO: Verify that this is correct.
+
+            # Handle flags
+            fileinfo.flag_bits = head_flags
+            fileinfo.not_first_piece = head_flags & 0x01
+            fileinfo.not_last_piece = head_flags & 0x02
+            fileinfo.is_encrypted = head_flags & 0x04
+            #TODO: Handle comments
+            fileinfo.is_solid = head_flags & 0x10
+
+            # TODO: Verify this is correct handling of bits 7,6,5 == 111
+            fileinfo.is_directory = head_flags & 0xe0
+
+            self.filelist.append(fileinfo)
+        elif self.debug > 0:
+            sys.stderr.write("Unhandled block: %s\n" % self._block_types.get(head_type, 'Unknown (0x%x)' % head_type))
+
+        # Line up for the next block
+        self._scan_offset = offset + head_size + add_size
+        return fileinfo
 
     def _read_struct(self, fmt):
         """Simplifies the process of extracting a struct from the open file."""
@@ -263,15 +288,40 @@ class RarFile(object):
                 crc = struct.pack('>H', crc)
             else:
                 crc = struct.pack('>L', crc)
-        return struct.pack('>L',zlib.crc32(data)).endswith(crc)
+        return struct.pack('>L', zlib.crc32(data) & 0xffffffff).endswith(crc)
+
+    def iterinfo(self, limit=None, match=None):
+        """Yield L{RarInfo} instances for the files in the archive, reading
+        block headers only as far as needed to produce the next one.
+
+        @param limit: Stop after yielding this many entries.
+        @param match: Optional callable taking a L{RarInfo}. Only entries it
+            returns true for are yielded (and counted towards C{limit}).
+
+        @note: Entries already read are remembered, so iterating again (or
+            calling L{infolist}) afterwards doesn't re-read their headers.
+        """
+        count, index = 0, 0
+        while limit is None or count < limit:
+            if index < len(self.filelist):
+                fileinfo = self.filelist[index]
+                index += 1
+                if match is None or match(fileinfo):
+                    count += 1
+                    yield fileinfo
+            elif self._scan_offset is None:
+                return
+            else:
+                self._readBlock()
 
     def infolist(self):
         """Return a list of L{RarInfo} instances for the files in the archive."""
+        self._getContents()
         return self.filelist
 
     def namelist(self):
         """Return a list of filenames for the files in the archive."""
-        return [x.filename for x in self.filelist]
+        return [x.filename for x in self.infolist()]
 
 def findRarHeader(handle, limit=FIND_LIMIT):
     """Searches a file-like object for a RAR header.
@@ -290,6 +340,13 @@ def findRarHeader(handle, limit=FIND_LIMIT):
     startPos, chunk = handle.tell(), ""
     limit = math.ceil(limit / float(CHUNK_SIZE)) * CHUNK_SIZE
 
+    # Fast path: Anything but an SFX bundle starts with the marker, so check
+    # for that before reading whole chunks.
+    if handle.read(len(MARKER_BLOCK)) == MARKER_BLOCK:
+        handle.seek(startPos)
+        return startPos + len(MARKER_BLOCK)
+    handle.seek(startPos)
+
     # Find the RAR header and line up for further reads. (Support SFX bundles)
     while True:
         temp = handle.read(CHUNK_SIZE)
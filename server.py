@@ -1,13 +1,18 @@
 #!/usr/bin/env python
 
+from archives import FileSlice, tar_index, extract_7z
+import cgi
 import ConfigParser
 import fnmatch
+import gzip
 import logging
 import mimetypes
 import os
+from profiling import RequestProfiler
 from rar import RarFile, BadRarFile
 import re
 from shutil import rmtree
+from StringIO import StringIO
 import subprocess
 import sys
 import zipfile
@@ -15,7 +20,7 @@ import zipfile
 from twisted.python.log import err
 from twisted.protocols.basic import FileSender
 from twisted.internet import reactor, defer, error as twistedErrors
-from twisted.web import server, resource
+from twisted.web import server, resource, static
 from twisted.web.resource import NoResource
 
 # Setup logging
@@ -54,6 +59,17 @@ FILENAME_SPACE_CLEANER = re.compile("\s+|\s+-\s+")
 
 ROOT = os.path.dirname(os.path.realpath(__file__))
 STORAGE_PATH = os.path.join(ROOT, "temporary_storage")
+PROFILE_PATH = os.path.join(ROOT, "profiles")
+# Unlike STORAGE_PATH this survives restarts, indexes are worth keeping
+INDEX_PATH = os.path.join(ROOT, "archive_index")
+
+# Registered (or at least widely used) types for whole-issue downloads
+COMIC_CONTENT_TYPES = {
+    ".cbr": "application/vnd.comicbook-rar",
+    ".cbz": "application/vnd.comicbook+zip",
+    ".cbt": "application/x-cbt",
+    ".cb7": "application/x-cb7",
+}
 
 # Caching
 CURRENT_ISSUE = {}
@@ -103,12 +119,92 @@ reactor.addSystemEventTrigger("before", "shutdown", clean_up)
 setup()
 
 
+def is_loopback(address):
+    """
+    Did a connection come from this machine? Covers IPv4 and IPv6
+    (including IPv4-mapped) loopback addresses.
+    """
+    host = getattr(address, "host", None)
+    if host is None:
+        return False
+    if host.startswith("::ffff:"):
+        host = host[len("::ffff:"):]
+    return host == "::1" or host.startswith("127.")
+
+
+def accepts_gzip(accept_encoding):
+    """
+    Does an Accept-Encoding header allow gzip? Honours an explicit q=0,
+    which is how a client says "anything but this". An explicit gzip (or
+    x-gzip) entry wins over "*", wherever it appears in the header.
+    """
+    if not accept_encoding:
+        return False
+    explicit = None
+    wildcard = None
+    for coding in accept_encoding.split(","):
+        parts = [p.strip() for p in coding.split(";")]
+        name = parts[0].lower()
+        if name not in ("gzip", "x-gzip", "*"):
+            continue
+        q = 1.0
+        for param in parts[1:]:
+            if param.replace(" ", "").startswith("q="):
+                try:
+                    q = float(param.split("=", 1)[1])
+                except ValueError:
+                    q = 0.0
+        if name == "*":
+            wildcard = q
+        else:
+            explicit = max(q, explicit) if explicit is not None else q
+    if explicit is not None:
+        return explicit > 0
+    return wildcard is not None and wildcard > 0
+
+
+def gzip_string(value):
+    buf = StringIO()
+    # mtime=0 keeps the output identical between runs for the same input
+    f = gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=9, mtime=0)
+    f.write(value)
+    f.close()
+    return buf.getvalue()
+
+
+class IssueDownload(static.File):
+    """
+    An original archive, sent as-is. static.File already does the hard parts:
+    a producer that only reads the next 64K when the transport asks for it,
+    single and multiple byte Range requests (so clients can resume) and
+    Last-Modified/If-Modified-Since.
+    """
+    contentTypes = dict(static.File.contentTypes, **COMIC_CONTENT_TYPES)
+
+    def render_GET(self, request):
+        filename = os.path.basename(self.path).replace('"', '\\"')
+        request.setHeader("Content-Disposition", 'attachment; filename="%s"' % filename)
+        return static.File.render_GET(self, request)
+
+
 class ComicServer(resource.Resource):
-    def __init__(self, directory):
+    def __init__(self, directory, profiler=None):
         # old-skool call to parent
         resource.Resource.__init__(self)
         self.titles = {}
 
+        # Always have a profiler around, even if it's switched off, so
+        # /debug/profile can turn it on without a restart
+        if profiler is None:
+            profiler = RequestProfiler(PROFILE_PATH)
+        self.profiler = profiler
+
+        # Rendered listing pages, keyed by route. Each entry remembers the
+        # catalog_version it was built from, so anything that changes titles
+        # just has to bump the version to make the cached pages stale.
+        self.catalog_version = 0
+        self.listing_cache = {}
+
         # TODO: directory handling - make sure ends in /,
         # replace Windows separator stuff with /
         self.directory = self._normalize_directory_path(directory)
@@ -121,10 +217,10 @@ class ComicServer(resource.Resource):
         self.ignored_folder_names = []
         total = 0
 
-        # when you find a cbr or cbz, put folder name into titles
+        # when you find a comic archive, put folder name into titles
         # problem here: fnmatch is only case-insensitive on case-insensitive OSes - replace?
         for root, dirnames, filenames in os.walk(self.directory):
-            matches = fnmatch.filter(filenames, "*.cb[r|z]")
+            matches = fnmatch.filter(filenames, "*.cb[rzt7]")
             matches.sort()
             if not matches:
                 self.ignored_folder_names.append(os.path.split(root)[-1])
@@ -172,6 +268,7 @@ class ComicServer(resource.Resource):
         file_key = self._slugify(filename)
         if file_key not in file_list:
             file_list[file_key] = file_path
+        self.catalog_version = self.catalog_version + 1
 
     def _prep_title(self, folder_name):
         """
@@ -226,16 +323,49 @@ class CBRResource(resource.Resource):
         self.parent = parent
 
     def render_GET(self, request):
+        profiler = self.parent.profiler
+        if profiler.enabled and profiler.should_profile(request.path):
+            return profiler.runcall(self.render_response, request)
+        return self.render_response(request)
+
+    def render_response(self, request):
         request.setHeader("content-type", "text/html")
         response = self.get_matching_response(request.path)
+        if isinstance(response, defer.Deferred):
+            # Still waiting on something slow (e.g. a 7z extraction), answer
+            # once it's done without holding up the reactor in the meantime
+            finished = []
+            request.notifyFinish().addBoth(finished.append)
+
+            def cbRender(response):
+                if finished:
+                    return
+                body = self._render_matched(request, response)
+                if body is not server.NOT_DONE_YET:
+                    request.write(body)
+                    request.finish()
+
+            def ebRender(failure):
+                if not finished:
+                    request.processingFailed(failure)
+
+            response.addCallback(cbRender).addErrback(ebRender)
+            return server.NOT_DONE_YET
+        return self._render_matched(request, response)
+
+    def _render_matched(self, request, response):
         if not response:
-            return None
+            return NoResource().render(request)
         if "static" in response:
             file_path = response["static"]
-            contentType, junk = mimetypes.guess_type(file_path)
+            # Archive members are served straight out of the archive, so
+            # guess the type from the member's name instead
+            contentType, junk = mimetypes.guess_type(response.get("name", file_path))
             request.setHeader("Content-Type",
                               contentType if contentType else "text/plain")
             fp = open(file_path, "rb")
+            if "size" in response:
+                fp = FileSlice(fp, response["offset"], response["size"])
             d = FileSender().beginFileTransfer(fp, request)
 
             def cbFinished(ignored):
@@ -244,6 +374,17 @@ class CBRResource(resource.Resource):
 
             d.addErrback(err).addCallback(cbFinished)
             return server.NOT_DONE_YET
+        if "download" in response:
+            download = IssueDownload(response["download"],
+                                     defaultType="application/octet-stream")
+            return download.render_GET(request)
+        if "cached" in response:
+            cached = response["cached"]
+            request.setHeader("Vary", "Accept-Encoding")
+            if accepts_gzip(request.getHeader("accept-encoding")):
+                request.setHeader("Content-Encoding", "gzip")
+                return cached["gzip"]
+            return cached["html"]
         return template % {
             "title": str(response["title"]),
             "body": str(response["body"])
@@ -255,15 +396,45 @@ class CBRResource(resource.Resource):
             top_folder = request_info[0]
             if top_folder == "favicon.ico":
                 return None
+            # Before the titles, so a comic called "Debug" can't hide it
+            if top_folder == "debug" and request_info[1:] == ["profile"]:
+                return self.request_profile()
             if top_folder == "issue" and len(request_info) == 3:
                 return self.request_issue(*request_info[1:])
-            if top_folder in self.parent.titles.keys():
+            if top_folder == "download" and len(request_info) == 3:
+                return self.request_download(*request_info[1:])
+            if top_folder in self.parent.titles:
                 return self.request_title_list(top_folder)
             if top_folder == "page" and len(request_info) == 4:
                 return self.request_page(*request_info[1:])
         return self.request_root()
 
     def request_root(self):
+        return self._cached_listing("root", self._render_root)
+
+    def request_title_list(self, title_key):
+        return self._cached_listing("title-%s" % title_key,
+                                    self._render_title_list, title_key)
+
+    def _cached_listing(self, cache_key, renderer, *args):
+        """
+        Listings only change when the catalog does, so render them once, keep
+        a gzipped copy alongside and hand back whichever the client can take.
+        """
+        cache = self.parent.listing_cache
+        version = self.parent.catalog_version
+        cached = cache.get(cache_key, None)
+        if not cached or cached["version"] != version:
+            response = renderer(*args)
+            html = template % {
+                "title": str(response["title"]),
+                "body": str(response["body"])
+            }
+            cached = {"version": version, "html": html, "gzip": gzip_string(html)}
+            cache[cache_key] = cached
+        return {"cached": cached}
+
+    def _render_root(self):
         response = "Serving contents of %s<ul>" % self.parent.directory
         for key in sorted(self.parent.titles.iterkeys()):
             entry = self.parent.titles[key]
@@ -275,7 +446,7 @@ class CBRResource(resource.Resource):
             "title": "Comix Server"
         }
 
-    def request_title_list(self, title_key):
+    def _render_title_list(self, title_key):
         entry = self.parent.titles[title_key]
         title = entry["full title"]
         content = "<h1>%s</h1><ul>" % (title)
@@ -289,13 +460,17 @@ class CBRResource(resource.Resource):
         }
 
     def request_issue(self, title_key, file_key):
-        file_contents = self._open_issue(title_key, file_key)
+        return self._with_issue(title_key, file_key, self._issue_listing)
+
+    def _issue_listing(self, file_contents, title_key, file_key):
         if not file_contents:
             return {
                 "body": "Unable to open %s" % file_key,
                 "title": title_key
             }
-        content = "<h1>Files in %s</h1><ul>" % (title_key)
+        content = "<h1>Files in %s</h1>" % (title_key)
+        content += '<p><a href="/download/%s/%s">Download this issue</a></p><ul>' % (
+            title_key, file_key)
         for position, f in enumerate(file_contents):
             content += '<li><a href="/page/%s/%s/%d">%s</a></li>' % (
                 title_key, file_key, (position + 1), os.path.basename(f)
@@ -306,18 +481,94 @@ class CBRResource(resource.Resource):
             "title": title_key
         }
 
+    def request_download(self, title_key, file_key):
+        """
+        The whole original archive for offline reading
+        """
+        entry = self.parent.titles.get(title_key, None)
+        if not entry:
+            return None
+        issue = entry["files"].get(file_key, None)
+        if not issue or not os.path.isfile(issue):
+            return None
+        return {"download": issue}
+
     def request_page(self, title_key, file_key, position):
         """
         Get a page inside a given issue
         """
-        file_contents = self._open_issue(title_key, file_key)
+        return self._with_issue(title_key, file_key, self._issue_page, position)
+
+    def _issue_page(self, file_contents, title_key, file_key, position):
         if not file_contents:
             return None
         try:
             position = int(position) - 1
         except TypeError:
             return None
-        return {"static": os.path.join(STORAGE_PATH, file_contents[position])}
+        page = file_contents[position]
+        issue = self.parent.titles[title_key]["files"][file_key]
+        if issue.lower().endswith(".cbt"):
+            offset, size = tar_index(issue, INDEX_PATH)[page]
+            return {"static": issue, "name": page, "offset": offset, "size": size}
+        return {"static": os.path.join(STORAGE_PATH, page)}
+
+    def request_profile(self):
+        """
+        Show profiler status and change it on the fly. Query arguments:
+            rate=0.05       profile this fraction of requests (0 turns it off)
+            pattern=^/page/ profile every request whose path matches
+            dump=1          write out what's been collected so far
+        Only answers requests from this machine: it changes server state on a
+        plain GET and a bad pattern would be run against every request.
+        """
+        if not is_loopback(self.request.getClientAddress()):
+            return None
+        profiler = self.parent.profiler
+        args = self.request.args
+        messages = []
+        # Check everything before changing anything
+        try:
+            rate = profiler.sample_rate
+            if "rate" in args:
+                rate = float(args["rate"][0])
+                if not 0 <= rate <= 1:
+                    raise ValueError("rate must be between 0 and 1")
+            if "pattern" in args:
+                re.compile(args["pattern"][0])
+        except (ValueError, re.error), e:
+            messages.append("Not changed: %s" % cgi.escape(str(e)))
+        else:
+            profiler.sample_rate = rate
+            if "pattern" in args:
+                profiler.pattern = args["pattern"][0]
+        if args.get("dump", ["0"])[0] not in ("", "0"):
+            path = profiler.dump()
+            messages.append("Wrote %s" % path if path else "Nothing to write yet")
+
+        content = "<h1>Profiling</h1>"
+        for message in messages:
+            content += "<p>%s</p>" % message
+        content += "<ul>"
+        status = profiler.status()
+        for key in sorted(status.iterkeys()):
+            content += "<li>%s: %s</li>" % (key, cgi.escape(str(status[key])))
+        content += "</ul>"
+        return {
+            "body": content,
+            "title": "Profiling"
+        }
+
+    def _with_issue(self, title_key, file_key, callback, *args):
+        """
+        Call callback(file_contents, title_key, file_key, *args) once the
+        issue is open. That's straight away for most formats, but opening a
+        .cb7 hands back a Deferred, in which case so do we.
+        """
+        file_contents = self._open_issue(title_key, file_key)
+        if isinstance(file_contents, defer.Deferred):
+            return file_contents.addCallback(callback, title_key, file_key, *args)
+        return callback(file_contents, title_key, file_key, *args)
 
     def _open_issue(self, title_key, file_key):
         """
@@ -337,6 +588,11 @@ class CBRResource(resource.Resource):
         if not issue:
             return None
         contents = self._open_issue_file(issue)
+        if isinstance(contents, defer.Deferred):
+            return contents.addCallback(self._cache_issue, cache_key)
+        return self._cache_issue(contents, cache_key)
+
+    def _cache_issue(self, contents, cache_key):
         if not contents:
             return None
         CURRENT_ISSUE[cache_key] = contents
@@ -347,21 +603,22 @@ class CBRResource(resource.Resource):
         Open issue file based on extension
         .cbr = RAR file
         .cbz = ZIP file
+        .cbt = TAR file, pages are served straight out of it using an index
+        .cb7 = 7z file, extracted in one go since they're usually solid.
+               Returns a Deferred, extraction happens in a child process
         See full file description at http://en.wikipedia.org/wiki/Comic_Book_Archive_file
         TODO: Handle additional types
-        .cb7 = 7z
-        .cbt = TAR
         .cba = ACE
         """
         if not os.path.exists(path):
             return None
         extension = path.lower()[-3:]
-        folder_name = path.split(os.sep)[-1].split(".")[0]
-        folder_path = os.path.join(STORAGE_PATH, folder_name)
-        if not os.path.exists(folder_path):
-            os.makedirs(folder_path)
 
         if extension == "cbz":
+            folder_name = path.split(os.sep)[-1].split(".")[0]
+            folder_path = os.path.join(STORAGE_PATH, folder_name)
+            if not os.path.exists(folder_path):
+                os.makedirs(folder_path)
             try:
                 z = zipfile.ZipFile(path)
                 files = self._filter_filenames(z.namelist())
@@ -369,14 +626,14 @@ class CBRResource(resource.Resource):
                 for f in files:
                     save_path = os.path.join(folder_path, f.split(os.sep)[-1])
                     try:
-                        save = open(save_path, "w")
+                        save = open(save_path, "wb")
                         save.write(z.read(f))
                         save.close()
                         paths.append(save_path)
                     except IOError:
                         logging.warn("Unable to open a file: %s" % save_path)
                         logging.warn("Original path: %s" % f)
-                return ["Could not extract the files from this issue"]
+                return paths
             except zipfile.BadZipfile:
                 return None
 
@@ -389,6 +646,17 @@ class CBRResource(resource.Resource):
             except BadRarFile:
                 logging.warn("Could not extract contents of %s" % path)
                 return ["Could not extract the files from this issue"]
+
+        if extension == "cbt":
+            members = tar_index(path, INDEX_PATH)
+            if members is None:
+                return None
+            return self._filter_filenames(members.keys())
+
+        if extension == "cb7":
+            d = extract_7z(path, STORAGE_PATH)
+            d.addCallback(lambda paths: self._filter_filenames(paths) if paths else None)
+            return d
         return None
 
     def _filter_filenames(self, name_list):
@@ -400,9 +668,22 @@ if __name__ == '__main__':
     try:
         config.read("comix.conf")
         port = int(config.get("basics", "port"))
+        profiler = RequestProfiler(PROFILE_PATH)
+        if config.has_section("profiling"):
+            if config.has_option("profiling", "directory"):
+                profiler.directory = config.get("profiling", "directory")
+            if config.has_option("profiling", "sample_rate"):
+                profiler.sample_rate = config.getfloat("profiling", "sample_rate")
+            if config.has_option("profiling", "pattern"):
+                profiler.pattern = config.get("profiling", "pattern")
+            if config.has_option("profiling", "flush_every"):
+                profiler.flush_every = config.getint("profiling", "flush_every")
+            if config.has_option("profiling", "backup_count"):
+                profiler.backup_count = config.getint("profiling", "backup_count")
+        reactor.addSystemEventTrigger("before", "shutdown", profiler.dump)
         try:
             reactor.listenTCP(port, server.Site(
-                ComicServer(config.get("basics", "directory")))
+                ComicServer(config.get("basics", "directory"), profiler))
             )
             logger.info("Listening on %d" % port)
             reactor.run()
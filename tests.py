@@ -1,9 +1,24 @@
 #!/usr/bin/env python
 
 import ConfigParser
+import gzip
+import os
+import struct
+import tarfile
+from shutil import rmtree
+from StringIO import StringIO
+import tempfile
 import unittest
+import zlib
 
-from server import ComicServer, CBRResource, IMAGE_FILE_EXTENSION_RE
+import archives
+from archives import FileSlice, tar_index, extract_7z, COMPLETE_MARKER
+from loadtest import classify, percentile
+from profiling import RequestProfiler, BASE_FILENAME
+from rar import RarFile, MARKER_BLOCK
+from twisted.internet.address import IPv4Address
+
+from server import ComicServer, CBRResource, IMAGE_FILE_EXTENSION_RE, accepts_gzip, is_loopback
 
 
 class TestComicParser(unittest.TestCase):
@@ -29,6 +44,231 @@ class TestCBRResource(unittest.TestCase):
         self.assertEqual(1, len(results))
         self.assertEqual(names[0], results[0])
 
+    def test_accepts_gzip(self):
+        self.assertTrue(accepts_gzip("gzip, deflate"))
+        self.assertTrue(accepts_gzip("deflate, *"))
+        self.assertFalse(accepts_gzip("gzip;q=0, deflate"))
+        self.assertTrue(accepts_gzip("*;q=0, gzip"))
+        self.assertFalse(accepts_gzip("gzip;q=0, *"))
+        self.assertFalse(accepts_gzip("deflate, *;q=0"))
+        self.assertFalse(accepts_gzip("identity"))
+        self.assertFalse(accepts_gzip(None))
+
+    def test_listing_cache(self):
+        directory = tempfile.mkdtemp()
+        try:
+            comics = ComicServer(directory)
+            resource = CBRResource("", None, comics)
+            first = resource.request_root()["cached"]
+            self.assertTrue(first is resource.request_root()["cached"])
+            self.assertEqual(first["html"], gzip.GzipFile(fileobj=StringIO(first["gzip"])).read())
+
+            comics._add_match_to_collection("Nexus 01.cbz", os.path.join(directory, "Nexus"))
+            second = resource.request_root()["cached"]
+            self.assertFalse(first is second)
+            self.assertTrue("nexus" in second["html"])
+        finally:
+            rmtree(directory)
+
+    def test_debug_profile_is_local_only(self):
+        class Request(object):
+            args = {"rate": ["1"]}
+
+            def __init__(self, host):
+                self.host = host
+
+            def getClientAddress(self):
+                return IPv4Address("TCP", self.host, 12345)
+
+        directory = tempfile.mkdtemp()
+        try:
+            # A title that slugifies to "debug" mustn't shadow the endpoint
+            os.makedirs(os.path.join(directory, "Debug"))
+            open(os.path.join(directory, "Debug", "Debug 01.cbz"), "wb").close()
+            comics = ComicServer(directory)
+            self.assertTrue("debug" in comics.titles)
+
+            remote = CBRResource("", Request("192.168.1.20"), comics)
+            self.assertEqual(None, remote.get_matching_response("/debug/profile"))
+            self.assertEqual(0, comics.profiler.sample_rate)
+
+            local = CBRResource("", Request("127.0.0.1"), comics)
+            self.assertEqual("Profiling", local.get_matching_response("/debug/profile")["title"])
+            self.assertEqual(1, comics.profiler.sample_rate)
+        finally:
+            rmtree(directory)
+
+    def test_is_loopback(self):
+        self.assertTrue(is_loopback(IPv4Address("TCP", "127.0.0.1", 80)))
+        self.assertFalse(is_loopback(IPv4Address("TCP", "10.0.0.1", 80)))
+        self.assertFalse(is_loopback(None))
+
+    def test_download(self):
+        directory = tempfile.mkdtemp()
+        try:
+            folder = os.path.join(directory, "Nexus")
+            os.makedirs(folder)
+            open(os.path.join(folder, "Nexus 01.cbz"), "wb").close()
+            resource = CBRResource("", None, ComicServer(directory))
+            self.assertEqual({"download": os.path.join(folder, "Nexus 01.cbz")},
+                             resource.get_matching_response("/download/nexus/nexus-01cbz"))
+            self.assertEqual(None, resource.request_download("nexus", "nexus-02cbz"))
+        finally:
+            rmtree(directory)
+
+
+class TestLoadTest(unittest.TestCase):
+    def test_classify(self):
+        self.assertEqual("root", classify("/"))
+        self.assertEqual("title", classify("/nexus/"))
+        self.assertEqual("issue", classify("/issue/nexus/nexus-01cbz/"))
+        self.assertEqual("page", classify("/page/nexus/nexus-01cbz/3"))
+        self.assertEqual("download", classify("/download/nexus/nexus-01cbz"))
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(50, percentile(values, 50))
+        self.assertEqual(99, percentile(values, 99))
+        self.assertEqual(None, percentile([], 95))
+
+
+class TestRequestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.directory)
+
+    def test_should_profile(self):
+        profiler = RequestProfiler(self.directory)
+        self.assertFalse(profiler.enabled)
+        profiler.pattern = "^/page/"
+        self.assertTrue(profiler.should_profile("/page/nexus/nexus-01cbz/3"))
+        self.assertFalse(profiler.should_profile("/"))
+        profiler.pattern = ""
+        profiler.sample_rate = 1.0
+        self.assertTrue(profiler.should_profile("/"))
+
+    def test_dumps_rotate(self):
+        profiler = RequestProfiler(self.directory, flush_every=1, backup_count=2)
+        for n in range(4):
+            self.assertEqual(n, profiler.runcall(lambda: n))
+        self.assertEqual(sorted([BASE_FILENAME, BASE_FILENAME + ".1", BASE_FILENAME + ".2"]),
+                         sorted(os.listdir(self.directory)))
+        self.assertEqual(None, profiler.dump())
+
+
+def build_rar(names, data="x" * 100):
+    """
+    Build a minimal stored (uncompressed) RAR archive in memory, just enough
+    for rar.py to parse: marker, archive header, then one block per file.
+    """
+    main_head = struct.pack("<BHHHL", 0x73, 0, 13, 0, 0)
+    rar = MARKER_BLOCK + struct.pack("<H", zlib.crc32(main_head) & 0xffff) + main_head
+    for name in names:
+        head = struct.pack("<BHH", 0x74, 0x8000, 32 + len(name))
+        head += struct.pack("<L", len(data))
+        head += struct.pack("<LBLLBBHL", len(data), 2, 0, 0, 20, 0x30, len(name), 0x20)
+        rar += struct.pack("<H", 0) + head + name + data
+    return StringIO(rar)
+
+
+class TestRarFile(unittest.TestCase):
+    names = ["cover.jpg", "Thumbs.db", "page02.jpg", "page03.jpg"]
+
+    def test_full_scan(self):
+        self.assertEqual(self.names, RarFile(build_rar(self.names)).namelist())
+
+    def test_iterinfo_stops_early(self):
+        rar = RarFile(build_rar(self.names), lazy=True)
+        self.assertEqual([], rar.filelist)
+        images = lambda info: IMAGE_FILE_EXTENSION_RE.search(info.filename)
+        first = [info.filename for info in rar.iterinfo(limit=2, match=images)]
+        self.assertEqual(["cover.jpg", "page02.jpg"], first)
+        # Never got as far as the last header
+        self.assertEqual(3, len(rar.filelist))
+        self.assertEqual(self.names, rar.namelist())
+
+
+class TestTarIndex(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "Nexus 01.cbt")
+        tar = tarfile.open(self.path, "w")
+        for n in range(1, 4):
+            data = "page %d" % n * 100
+            info = tarfile.TarInfo("nexus/page%02d.jpg" % n)
+            info.size = len(data)
+            tar.addfile(info, StringIO(data))
+        tar.close()
+        self.index_directory = os.path.join(self.directory, "index")
+
+    def tearDown(self):
+        archives.TAR_INDEXES.clear()
+        rmtree(self.directory)
+
+    def test_index_and_slice(self):
+        index = tar_index(self.path, self.index_directory)
+        self.assertEqual(["nexus/page01.jpg", "nexus/page02.jpg", "nexus/page03.jpg"], index.keys())
+        offset, size = index["nexus/page02.jpg"]
+        page = FileSlice(open(self.path, "rb"), offset, size)
+        self.assertEqual("page 2" * 100, page.read(4096))
+        self.assertEqual("", page.read(4096))
+        page.close()
+
+    def test_index_is_persisted(self):
+        index = tar_index(self.path, self.index_directory)
+        archives.TAR_INDEXES.clear()
+        self.assertEqual(1, len(os.listdir(self.index_directory)))
+        self.assertEqual(index, tar_index(self.path, self.index_directory))
+
+
+class TestExtract7z(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.commands = archives.SEVEN_ZIP_COMMANDS
+        # Make sure nothing ever actually gets run
+        archives.SEVEN_ZIP_COMMANDS = ["no-such-7z-command"]
+
+    def tearDown(self):
+        archives.SEVEN_ZIP_COMMANDS = self.commands
+        rmtree(self.directory)
+
+    def make_issue(self, name):
+        path = os.path.join(self.directory, name)
+        open(path, "wb").write(name)
+        return path
+
+    def extracted(self, path):
+        results = []
+        extract_7z(path, self.directory).addCallback(results.append)
+        self.assertEqual(1, len(results))
+        return results[0]
+
+    def test_folders_are_per_archive(self):
+        first = self.make_issue("Nexus v1.01.cb7")
+        second = self.make_issue("Nexus v1.02.cb7")
+        stat = os.stat(first)
+        folder = os.path.join(self.directory, "7z-" + archives.hashlib.sha1(first).hexdigest())
+        os.makedirs(folder)
+        open(os.path.join(folder, "issue1_page01.jpg"), "wb").close()
+        open(os.path.join(folder, COMPLETE_MARKER), "w").write(
+            "[%d, %d]" % (stat.st_size, int(stat.st_mtime)))
+
+        self.assertEqual([os.path.join(folder, "issue1_page01.jpg")], self.extracted(first))
+        # No 7z here, so the other issue can't borrow the first one's pages
+        self.assertEqual(None, self.extracted(second))
+
+    def test_incomplete_or_stale_extraction_not_reused(self):
+        path = self.make_issue("Nexus 01.cb7")
+        folder = os.path.join(self.directory, "7z-" + archives.hashlib.sha1(path).hexdigest())
+        os.makedirs(folder)
+        open(os.path.join(folder, "page01.jpg"), "wb").close()
+        self.assertEqual(None, self.extracted(path))
+
+        open(os.path.join(folder, COMPLETE_MARKER), "w").write("[0, 0]")
+        self.assertEqual(None, self.extracted(path))
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file